@@ -1,5 +1,7 @@
 import os  
+import sys
 import time
+import asyncio
 import json
 import logging
 from dotenv import load_dotenv
@@ -11,14 +13,22 @@ from websockets.exceptions import ConnectionClosedError
 from dataclasses import dataclass, field
 from typing import Dict, Any
 import re  # <-- for normalization
+import queue
+import threading
+from concurrent.futures import Future
+from importlib.resources import files
+
+import numpy as np
+import orjson
 
 # ─── Pipecat Core ────────────────────────────────────────────────────────────
 from pipecat.pipeline.pipeline import Pipeline
 from pipecat.pipeline.task import PipelineTask, PipelineParams
 from pipecat.pipeline.runner import PipelineRunner
 from pipecat.processors.frameworks.rtvi import RTVIProcessor, RTVIObserver
-from pipecat.audio.vad.silero import SileroVADAnalyzer, VADParams
-from pipecat.frames.frames import InputAudioRawFrame, OutputAudioRawFrame
+from pipecat.audio.vad.silero import SileroOnnxModel, VADParams
+from pipecat.audio.vad.vad_analyzer import VADAnalyzer, VADState
+from pipecat.frames.frames import InputAudioRawFrame, OutputAudioRawFrame, StartInterruptionFrame
 from pipecat.serializers.base_serializer import FrameSerializer, FrameSerializerType
 
 # ─── Transports ──────────────────────────────────────────────────────────────
@@ -35,6 +45,7 @@ from pipecat.services.gemini_multimodal_live.gemini import (
 from pipecat.services.llm_service import FunctionCallParams
 
 # ─── Tool-calling helpers ────────────────────────────────────────────────────
+from pipecat.adapters.schemas.function_schema import FunctionSchema
 from pipecat.adapters.schemas.tools_schema import ToolsSchema
 from pipecat.processors.aggregators.openai_llm_context import OpenAILLMContext
 
@@ -43,57 +54,227 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voice-agent")
 
+# ─── Normalization patterns (compiled once, used on every utterance) ─────────
+_AT_RATE_RE = re.compile(r"\s+at\s+the\s+rate(\s+of)?\s+", re.IGNORECASE)
+_NAME_PREFIX_RE = re.compile(r"^\s*(my name is|name is|i am|i'm)(?:\s+|$)", re.IGNORECASE)
+
 app = FastAPI(title="Ultra-Low-Latency Voice Agent")
 
 
-# ─── 1) Robust transport that never drops the pipeline ───────────────────────
-class RobustWebsocketTransport(FastAPIWebsocketTransport):
-    async def _receive_messages(self):
-        try:
-            while self._ws and not self._closed:
+# ─── 1) Silero VAD: cross-connection batching + cheap RMS gate ──────────────
+class VADBatcher:
+    """Coalesces Silero forward passes from all connections into batched ORT runs.
+
+    Pipecat calls ``analyze_audio`` from each transport's executor thread, so
+    callers block on a ``Future`` (up to ``timeout_secs``) while ``workers``
+    threads pull up to ``max_batch`` chunks at a time and run the shared
+    session. A worker only waits ``window_secs`` for company when the queue is
+    empty; under load it keeps draining full batches back to back.
+    """
+
+    def __init__(
+        self,
+        session,
+        window_secs: float = 0.005,
+        max_batch: int = 16,
+        workers: int = os.cpu_count() or 1,
+        timeout_secs: float = 1.0,
+    ):
+        self._session = session
+        self._window_secs = window_secs
+        self._max_batch = max_batch
+        self._timeout_secs = timeout_secs
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        for n in range(workers):
+            threading.Thread(target=self._run, name=f"vad-batcher-{n}", daemon=True).start()
+
+    def infer(self, x: np.ndarray, state: np.ndarray, sr: int):
+        fut: Future = Future()
+        self._queue.put((x, state, sr, fut))
+        # Raises TimeoutError rather than hanging the executor if workers die.
+        return fut.result(timeout=self._timeout_secs)
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            if self._queue.empty():
+                time.sleep(self._window_secs)
+            while len(pending) < self._max_batch:
                 try:
-                    msg = await self._ws.receive()
-                except (WebSocketDisconnect, ConnectionClosedError):
-                    return
-
-                if msg.get("bytes") is not None:
-                    logger.debug(f"Audio frame received at {time.time()*1000:.1f}ms")
-                audio_bytes = msg.get("bytes")
-                if audio_bytes and isinstance(audio_bytes, (bytes, bytearray)):
-                    frame = InputAudioRawFrame(
-                        audio=audio_bytes, sample_rate=16_000, num_channels=1
-                    )
-                    await self.push_audio_frame(frame)
-                    continue
-
-                # drop any text pings
-                if msg.get("text") is not None:
-                    continue
-
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(pending)
+
+    def _run_batch(self, pending: list):
+        by_sr: Dict[int, list] = {}
+        for item in pending:
+            by_sr.setdefault(item[2], []).append(item)
+        for sr, items in by_sr.items():
+            try:
+                out, state = self._session.run(None, {
+                    "input": np.concatenate([i[0] for i in items]),
+                    "state": np.concatenate([i[1] for i in items], axis=1),
+                    "sr": np.array(sr, dtype=np.int64),
+                })
+            except Exception as e:
+                for i in items:
+                    i[3].set_exception(e)
+                continue
+            for n, i in enumerate(items):
+                i[3].set_result((out[n:n + 1], state[:, n:n + 1]))
+
+
+class BatchedSileroModel:
+    """Drop-in for Pipecat's ``SileroOnnxModel`` that keeps this connection's
+    LSTM state and context locally and runs inference through a ``VADBatcher``."""
+
+    def __init__(self, batcher: VADBatcher):
+        self._batcher = batcher
+        self.reset_states()
+
+    def reset_states(self, batch_size: int = 1):
+        self._state = np.zeros((2, batch_size, 128), dtype=np.float32)
+        self._context = None
+
+    def __call__(self, x: np.ndarray, sr: int):
+        if x.ndim == 1:
+            x = x[np.newaxis, :]
+        context_size = 64 if sr == 16_000 else 32
+        if self._context is None:
+            self._context = np.zeros((1, context_size), dtype=np.float32)
+        x = np.concatenate((self._context, x), axis=1)
+        out, self._state = self._batcher.infer(x, self._state, sr)
+        self._context = x[:, -context_size:]
+        return out
+
+
+def load_vad_batcher() -> VADBatcher:
+    """Batcher over one session of the Silero model bundled with Pipecat."""
+    # Pipecat's loader pins ORT to one intra/inter-op thread.
+    path = str(files("pipecat.audio.vad.data").joinpath("silero_vad.onnx"))
+    return VADBatcher(SileroOnnxModel(path, force_onnx_cpu=True).session)
+
+
+class GatedSileroVAD(VADAnalyzer):
+    """Silero VAD on a shared ``VADBatcher`` that skips the forward pass for
+    chunks sitting at the noise floor.
+
+    Built on ``VADAnalyzer`` rather than ``SileroVADAnalyzer`` so no connection
+    loads its own copy of the model; this object only holds the connection's
+    LSTM state (via ``BatchedSileroModel``).
+
+    The noise floor is an EMA of chunk RMS, updated only while the VAD state is
+    QUIET. It falls fast, rises slowly and never exceeds ``max_noise_floor``,
+    so speech cannot ratchet it up. Skipped chunks leave the model's LSTM
+    state untouched; after ``reset_after_secs`` of gated silence the state is
+    reset so the next utterance starts clean.
+    """
+
+    def __init__(
+        self,
+        batcher: VADBatcher,
+        *,
+        gate_ratio: float = 3.0,
+        noise_floor: float = 0.0015,  # ~-56 dBFS
+        max_noise_floor: float = 0.003,  # ~-50 dBFS
+        reset_after_secs: float = 2.0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._model = BatchedSileroModel(batcher)
+        self._gate_ratio = gate_ratio
+        self._noise_floor = noise_floor
+        self._max_noise_floor = max_noise_floor
+        self._reset_after_secs = reset_after_secs
+        self._gated_secs = 0.0
+        self._last_reset = time.monotonic()
+
+    def set_sample_rate(self, sample_rate: int):
+        if sample_rate not in (8_000, 16_000):
+            raise ValueError(f"Silero VAD sample rate needs to be 16000 or 8000 (sample rate: {sample_rate})")
+        super().set_sample_rate(sample_rate)
+
+    def num_frames_required(self) -> int:
+        return 512 if self.sample_rate == 16_000 else 256
+
+    def voice_confidence(self, buffer) -> float:
+        # One int16 -> float32 conversion per chunk, shared by the gate and Silero.
+        samples = np.frombuffer(buffer, dtype=np.int16).astype(np.float32)
+        samples *= 1 / 32768
+        rms = float(np.sqrt(np.mean(samples * samples))) if samples.size else 0.0
+
+        # _vad_state is still the previous chunk's state at this point.
+        if self._vad_state == VADState.QUIET:
+            alpha = 0.1 if rms < self._noise_floor else 0.01
+            self._noise_floor = min(
+                (1 - alpha) * self._noise_floor + alpha * rms, self._max_noise_floor
+            )
+
+        if rms < self._gate_ratio * self._noise_floor:
+            self._gated_secs += samples.size / self.sample_rate
+            if self._gated_secs > self._reset_after_secs:
+                self._model.reset_states()
+                self._gated_secs = 0.0
+            return 0.0
+
+        self._gated_secs = 0.0
+        return self._infer(samples)
+
+    def _infer(self, samples: np.ndarray) -> float:
+        # Mirrors SileroVADAnalyzer.voice_confidence, minus re-parsing the buffer.
+        try:
+            confidence = float(self._model(samples, self.sample_rate).item())
         except Exception:
-            logger.exception("Unexpected error in receive loop")
-        finally:
-            return
+            logger.exception("Silero VAD inference failed")
+            return 0.0
+        now = time.monotonic()
+        if now - self._last_reset >= 5.0:
+            self._model.reset_states()
+            self._last_reset = now
+        return confidence
+
+
+# Loaded once at import so no connection pays the ONNX session start-up; each
+# analyzer only allocates its own LSTM state.
+VAD_BATCHER = load_vad_batcher()
 
 
 # ─── 2) Form state + PCM serializer ──────────────────────────────────────────
-@dataclass
+@dataclass(slots=True)
 class FormState:
     form_type: str | None = None
-    fields: Dict[str, Any] = field(default_factory=dict)
+    name: str | None = None
+    email: str | None = None
 
     def open(self):
         self.form_type = "registration"
-        self.fields.clear()
+        self.name = None
+        self.email = None
 
     def fill(self, field: str, value: str):
-        self.fields[field] = value
+        if field == "email":
+            self.email = value
+        else:
+            self.name = value
 
     def dump(self) -> Dict[str, Any]:
-        return {"form_type": self.form_type, **self.fields}
+        return {"form_type": self.form_type, "name": self.name, "email": self.email}
 
 
 class PCMBytesSerializer(FrameSerializer):
+    """Raw PCM in both directions.
+
+    With a ``send_queue``, output audio is handed to ``audio_sender`` instead
+    of being written inline, so a slow socket never stalls the model: the
+    queue drops its oldest chunk when full and is flushed on interruption.
+    """
+
+    def __init__(self, send_queue: asyncio.Queue | None = None):
+        super().__init__()
+        self._send_queue = send_queue
+        self._dropped = 0
+
     @property
     def type(self) -> FrameSerializerType:
         return FrameSerializerType.BINARY
@@ -103,102 +284,122 @@ class PCMBytesSerializer(FrameSerializer):
 
     async def serialize(self, frame) -> bytes | None:
         if isinstance(frame, OutputAudioRawFrame):
-            logger.debug(f"Sending audio frame at {time.time()*1000:.1f}ms")
-            return frame.audio
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending audio frame at %d ns", time.monotonic_ns())
+            if self._send_queue is None:
+                return frame.audio
+            if self._send_queue.full():
+                self._send_queue.get_nowait()
+                self._dropped += 1
+                if self._dropped == 1 or self._dropped % 100 == 0:
+                    logger.warning("Audio send queue full: dropped %d output chunk(s) so far", self._dropped)
+            self._send_queue.put_nowait(frame.audio)
+        elif isinstance(frame, StartInterruptionFrame) and self._send_queue is not None:
+            while not self._send_queue.empty():
+                self._send_queue.get_nowait()
         return None
 
     async def deserialize(self, data: bytes):
+        # Pipecat's input transport reads every inbound message through here.
+        # Starlette hands us an immutable ``bytes``; pass it through as-is so
+        # no copy is made before the frame reaches VAD / the LLM.
+        if not data:
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Audio frame received at %d ns", time.monotonic_ns())
         return InputAudioRawFrame(audio=data, sample_rate=16_000, num_channels=1)
 
 
-# ─── 3) WebSocket endpoint & pipeline ───────────────────────────────────────
-@app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket, voice: str | None = None):
-    setup_start = time.time()
-    await ws.accept()
-    logger.info(f"Connection setup latency: {(time.time()-setup_start)*1000:.1f}ms")
+async def audio_sender(ws: WebSocket, send_queue: asyncio.Queue):
+    try:
+        while True:
+            await ws.send_bytes(await send_queue.get())
+    except (WebSocketDisconnect, ConnectionClosedError, RuntimeError) as e:
+        # socket went away; the pipeline tears itself down separately
+        logger.warning("Audio sender stopped, output audio is no longer delivered: %r", e)
 
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        await ws.send_json({"error": "GEMINI_API_KEY not set"})
-        await ws.close(code=4401)
-        return
 
-    transport = RobustWebsocketTransport(
-        websocket=ws,
-        params=FastAPIWebsocketParams(
-            audio_in_enabled=True,
-            audio_out_enabled=True,
-            serializer=PCMBytesSerializer(),
-            vad_analyzer=SileroVADAnalyzer(
-                params=VADParams(confidence=0.8, start_secs=0.1, stop_secs=0.2, min_volume=0.5)
-            ),
-        ),
-    )
+async def send_json_fast(ws: WebSocket, obj: Dict[str, Any]):
+    """``ws.send_json`` via orjson. Kept as a text frame: the frontend treats
+    every binary frame as PCM audio."""
+    await ws.send_text(orjson.dumps(obj).decode())
+
+
+# ─── 3) Form tools (one session per connection) ──────────────────────────────
+# Never mutated: orjson and the LLM callback only read it.
+_OPEN_RESP: Dict[str, Any] = {"status": "opened", "form_type": "registration"}
+
+@dataclass(slots=True)
+class FormSession:
+    """Per-connection form state plus the tools Gemini calls, as bound methods."""
+
+    ws: WebSocket
+    state: FormState = field(default_factory=FormState)
 
-    form_state = FormState()
+    async def _emit(self, params: FunctionCallParams, resp: Dict[str, Any]):
+        # Push to the LLM and the browser concurrently.
+        await asyncio.gather(params.result_callback(resp), send_json_fast(self.ws, resp))
 
-    # ─── tool implementations ─────────────────────────────────────────────────
-    async def open_form(params: FunctionCallParams):
-        t0 = time.time()
-        form_state.open()
-        resp = {"status": "opened", "form_type": "registration"}
-        await params.result_callback(resp)
-        await ws.send_json(resp)
-        logger.info(f"open_form() completed in {(time.time()-t0)*1000:.1f}ms")
+    async def open_form(self, params: FunctionCallParams):
+        t0 = time.perf_counter_ns()
+        self.state.open()
+        await self._emit(params, _OPEN_RESP)
+        logger.info("open_form() completed in %.1fms", (time.perf_counter_ns() - t0) / 1e6)
 
-    async def fill_form_field(params: FunctionCallParams, value: str):
-        t0 = time.time()
-        if form_state.form_type is None:
-            form_state.open()
+    async def fill_form_field(self, params: FunctionCallParams, value: str):
+        t0 = time.perf_counter_ns()
+        if self.state.form_type is None:
+            self.state.open()
 
-        text = value.lower().strip()
-        text = re.sub(r"\s+at\s+the\s+rate(\s+of)?\s+", "@", text)
-        text = re.sub(r"\b(my name is|name is|i am|i'm)\b", "", text).strip()
+        text = value.strip()
+        # Names are the common case and rarely contain "rate": a substring test
+        # skips the "at the rate" regex for most of them (when it doesn't, the
+        # regex simply finds no match).
+        if "rate" in text.lower():
+            text = _AT_RATE_RE.sub("@", text)
+        text = _NAME_PREFIX_RE.sub("", text, count=1).strip()
 
         if "@" in text:
             field = "email"
-            candidate = text
+            candidate = text.lower()
         else:
             field = "name"
             candidate = text
 
         if not candidate:
             err = {"error": "no_field_detected"}
-            await params.result_callback(err)
-            await ws.send_json(err)
-            logger.info(f"fill_form_field() error in {(time.time()-t0)*1000:.1f}ms")
+            await self._emit(params, err)
+            logger.info("fill_form_field() error in %.1fms", (time.perf_counter_ns() - t0) / 1e6)
             return
 
-        form_state.fill(field, candidate)
+        self.state.fill(field, candidate)
         resp = {"status": "filled", "field": field, "value": candidate}
-        await params.result_callback(resp)
-        await ws.send_json(resp)
-        logger.info(f"fill_form_field() completed in {(time.time()-t0)*1000:.1f}ms")
+        await self._emit(params, resp)
+        logger.info("fill_form_field() completed in %.1fms", (time.perf_counter_ns() - t0) / 1e6)
 
-    async def submit_form(params: FunctionCallParams):
-        t0 = time.time()
-        data = form_state.dump()
+    async def submit_form(self, params: FunctionCallParams):
+        t0 = time.perf_counter_ns()
+        data = self.state.dump()
         resp = {"status": "submitted", "data": data}
-        await params.result_callback(resp)
-        await ws.send_json(resp)
-        form_state.open()
-        logger.info(f"submit_form() completed in {(time.time()-t0)*1000:.1f}ms")
-
-    # ─── register + boot LLM ───────────────────────────────────────────────────
-    tools = ToolsSchema(standard_tools=[open_form, fill_form_field, submit_form])
-    llm = GeminiMultimodalLiveLLMService(
-        api_key=api_key,
-        voice_id=voice or "Puck",
-        tools=tools,
-        params=InputParams(temperature=0.0, max_tokens=50),
-        run_in_parallel=False,
-    )
-    llm.register_direct_function(open_form)
-    llm.register_direct_function(fill_form_field)
-    llm.register_direct_function(submit_form)
-
-    system_prompt = """\
+        await self._emit(params, resp)
+        self.state.open()
+        logger.info("submit_form() completed in %.1fms", (time.perf_counter_ns() - t0) / 1e6)
+
+
+# Built once at import: the schemas are static and only the handlers are bound
+# per connection (register_direct_function matches them by method name).
+TOOLS_SCHEMA = ToolsSchema(standard_tools=[
+    FunctionSchema(name="open_form", description="Open the registration form.", properties={}, required=[]),
+    FunctionSchema(
+        name="fill_form_field",
+        description="Fill one form field (name or email) from the user's utterance.",
+        properties={"value": {"type": "string", "description": "The spoken name or email."}},
+        required=["value"],
+    ),
+    FunctionSchema(name="submit_form", description="Submit the filled form.", properties={}, required=[]),
+])
+
+SYSTEM_PROMPT = """\
 You are an automated form-filling assistant with exactly three functions:
   • open_form()
   • fill_form_field(value: str)
@@ -214,7 +415,51 @@ RULES:
 3) Strip prefixes (“my name is…”) and normalize “at the rate” to “@.”
 4) Call fill_form_field(value=…) once per field.
 5) When the user says “submit,” immediately call submit_form()."""
-    context = OpenAILLMContext([{"role": "system", "content": system_prompt}], tools=tools)
+SYSTEM_PROMPT_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# ─── 4) WebSocket endpoint & pipeline ───────────────────────────────────────
+@app.websocket("/ws")
+async def websocket_endpoint(ws: WebSocket, voice: str | None = None):
+    setup_start = time.time()
+    await ws.accept()
+    logger.info(f"Connection setup latency: {(time.time()-setup_start)*1000:.1f}ms")
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        await send_json_fast(ws, {"error": "GEMINI_API_KEY not set"})
+        await ws.close(code=4401)
+        return
+
+    send_queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=64)
+    transport = FastAPIWebsocketTransport(
+        websocket=ws,
+        params=FastAPIWebsocketParams(
+            audio_in_enabled=True,
+            audio_out_enabled=True,
+            serializer=PCMBytesSerializer(send_queue),
+            vad_analyzer=GatedSileroVAD(
+                VAD_BATCHER,
+                params=VADParams(confidence=0.8, start_secs=0.1, stop_secs=0.2, min_volume=0.5)
+            ),
+        ),
+    )
+
+    session = FormSession(ws)
+
+    # ─── register + boot LLM ───────────────────────────────────────────────────
+    llm = GeminiMultimodalLiveLLMService(
+        api_key=api_key,
+        voice_id=voice or "Puck",
+        tools=TOOLS_SCHEMA,
+        params=InputParams(temperature=0.0, max_tokens=50),
+        run_in_parallel=False,
+    )
+    llm.register_direct_function(session.open_form)
+    llm.register_direct_function(session.fill_form_field)
+    llm.register_direct_function(session.submit_form)
+
+    context = OpenAILLMContext([SYSTEM_PROMPT_MSG], tools=TOOLS_SCHEMA)
     context_agg = llm.create_context_aggregator(context)
 
     # ─── pipeline setup ────────────────────────────────────────────────────────
@@ -233,11 +478,13 @@ RULES:
         observers=[RTVIObserver(rtvi)],
     )
 
+    sender_task = asyncio.create_task(audio_sender(ws, send_queue))
     try:
         await PipelineRunner(handle_sigint=False).run(task)
     except (WebSocketDisconnect, ConnectionClosedError):
         pass
     finally:
+        sender_task.cancel()
         await ws.close()
 
 
@@ -247,4 +494,8 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=int(os.getenv("PORT", "8000")),
         log_level="info",
+        # uvloop has no Windows build; fall back to the stock asyncio loop there.
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        ws="websockets",
     )